@@ -1,9 +1,14 @@
-from argparse import ArgumentParser
+import os
+import zlib
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import h5py
 import OpenEXR
+import Imath
 
 from tqdm import tqdm
 
@@ -27,43 +32,145 @@ def get_argument_parser():
     parser.add_argument(
         '-fps', '--frames-per-sequence', type=int, default=100,
         help="number of frames per sequence")
-    parser.add_argument(
-        '-fd', '--frame-index-digits', type=int, default=3,
-        help="number of digits in the frame name")
     parser.add_argument(
         '-sd', '--sequence-index-digits', type=int, default=3,
         help="number of digits in the sequence name")
+    parser.add_argument(
+        '-j', '--workers', type=positive_int, default=os.cpu_count(),
+        help="number of worker processes decoding EXR frames, fewer workers give each one more OpenEXR decode threads")
     return parser
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
+
 def peak_frame_count(subdir: Path) -> int:
     return len([file for file in subdir.glob("*.exr")])
 
-def load_exr_layer(file, name, width, height, with_alpha=False, use_xyzw=False):
-    r = file.channel(f'ViewLayer.{name}.R' if not use_xyzw else f'ViewLayer.{name}.X')
-    g = file.channel(f'ViewLayer.{name}.G' if not use_xyzw else f'ViewLayer.{name}.Y')
-    b = file.channel(f'ViewLayer.{name}.B' if not use_xyzw else f'ViewLayer.{name}.Z')
-    
-    r_array = np.frombuffer(r, dtype=np.float32).reshape(height, width)
-    g_array = np.frombuffer(g, dtype=np.float32).reshape(height, width)
-    b_array = np.frombuffer(b, dtype=np.float32).reshape(height, width)
-    channel_arrays = [r_array, g_array, b_array]
+FLOAT = Imath.PixelType(Imath.PixelType.FLOAT)
+
+def layer_channels(name, components):
+    return tuple(f'ViewLayer.{name}.{c}' for c in components)
+
+# Dataset name, EXR channels and storage type of every packaged layer, built once rather than per frame.
+# HDR radiance and motion vectors keep full precision, bounded G-buffer layers are stored in 16 bits
+LAYER_SPECS = [
+    ('combined',    layer_channels('Combined', 'RGBA'), np.float32),
+    ('normal',      layer_channels('Normal', 'XYZ'),    np.int16),
+    ('vector',      layer_channels('Vector', 'XYZW'),   np.float32),
+    ('depth',       layer_channels('Mist', 'Z'),        np.float32),
+    ('diffuse-col', layer_channels('DiffCol', 'RGB'),   np.float16),
+    ('diffuse-dir', layer_channels('DiffDir', 'RGB'),   np.float32),
+    ('diffuse-ind', layer_channels('DiffInd', 'RGB'),   np.float32),
+    ('glossy-col',  layer_channels('GlossCol', 'RGB'),  np.float16),
+    ('glossy-dir',  layer_channels('GlossDir', 'RGB'),  np.float32),
+    ('glossy-ind',  layer_channels('GlossInd', 'RGB'),  np.float32),
+    ('emission',    layer_channels('Emit', 'RGB'),      np.float32),
+    ('environment', layer_channels('Env', 'RGB'),       np.float32),
+    ('roughness',   layer_channels('Roughness', 'X'),   np.float16),
+]
+
+# Every EXR channel of a frame, requested together so that each compressed scanline block is decoded only once
+FRAME_CHANNELS = [channel for _, channels, _ in LAYER_SPECS for channel in channels]
 
-    if with_alpha:
-        a = file.channel(f'ViewLayer.{name}.A' if not use_xyzw else f'ViewLayer.{name}.W')
-        a_array = np.frombuffer(a, dtype=np.float32).reshape(height, width)
-        channel_arrays.append(a_array)
+# Decode buffer of the current resolution, allocated once per worker process and reused for every frame
+FRAME_BUFFERS = {}
 
-    return np.stack(channel_arrays, axis=0)
+def get_frame_buffers(width, height):
+    # Returns the (channels, H, W) frame buffer along with a view of it for every layer
+    if (width, height) not in FRAME_BUFFERS:
+        FRAME_BUFFERS.clear()
+        frame = np.empty((len(FRAME_CHANNELS), height, width), dtype=np.float32)
+        layers, start = {}, 0
+        for name, channels, _ in LAYER_SPECS:
+            layers[name] = frame[start:start + len(channels)]
+            start += len(channels)
+        FRAME_BUFFERS[(width, height)] = frame, layers
+    return FRAME_BUFFERS[(width, height)]
 
-def load_exr_layer_single(file, name, width, height):
-    x = file.channel(f'ViewLayer.{name}')
-    return np.frombuffer(x, dtype=np.float32).reshape(height, width)
+def read_frame(file, out):
+    # Pull all channels of the frame in a single call and copy each one into its plane of the output
+    height, width = out.shape[1:]
+    for i, c in enumerate(file.channels(FRAME_CHANNELS, FLOAT)):
+        out[i] = np.frombuffer(c, dtype=np.float32).reshape(height, width)
+
+def quantize(data, dtype):
+    # Integer layers hold values in [-1, 1] as fixed point, readers divide by the dataset's 'scale' attribute
+    if np.issubdtype(dtype, np.integer):
+        return np.round(np.clip(data, -1, 1) * np.iinfo(dtype).max).astype(dtype)
+    return data.astype(dtype, copy=False)
+
+COMPRESSION_LEVEL = 1
+
+def compress_chunk(data):
+    # Apply HDF5's shuffle + deflate filters by hand so that workers can compress chunks in parallel
+    # and the writer can store them as-is, bypassing the HDF5 filter pipeline
+    shuffled = np.ascontiguousarray(data).view(np.uint8).reshape(-1, data.itemsize).T.tobytes()
+    return zlib.compress(shuffled, COMPRESSION_LEVEL)
+
+def add_dataset(group, name, shape, dtype):
+    # Frames are stacked along the first axis and one chunk holds exactly one frame of the layer,
+    # (1, C, H, W) or (1, H, W), so every write covers a whole chunk and never needs a fill value.
+    # The filters must match what compress_chunk applies
+    dataset = group.create_dataset(
+        name, shape=shape, dtype=dtype, chunks=(1, *shape[1:]), fill_time='never', track_times=False,
+        compression='gzip', compression_opts=COMPRESSION_LEVEL, shuffle=True)
+    if np.issubdtype(dtype, np.integer):
+        dataset.attrs['scale'] = np.iinfo(dtype).max
+    return dataset
+
+def write_chunks(dataset, chunks):
+    # Store a pre-compressed chunk for every frame, one chunk per frame
+    offset = (0,) * (dataset.ndim - 1)
+    for frame, chunk in enumerate(chunks):
+        dataset.id.write_direct_chunk((frame, *offset), chunk)
 
 def get_image_dims(header):
     width  = header['dataWindow'].max.x - header['dataWindow'].min.x + 1
     height = header['dataWindow'].max.y - header['dataWindow'].min.y + 1
     return width, height
 
+def split_alpha(combined):
+    # Cycles alpha is usually a constant plane, in which case only its value is returned
+    rgb, alpha = combined[:3], combined[3]
+    constant = alpha.flat[0]
+    return rgb, float(constant) if np.all(alpha == constant) else alpha
+
+def decode_frame(frame_file):
+    exr = OpenEXR.InputFile(str(frame_file))
+    width, height = get_image_dims(exr.header())
+    frame, layer_buffers = get_frame_buffers(width, height)
+    read_frame(exr, frame)
+    exr.close()
+
+    # Single-channel layers are stored as plain (H, W) images
+    layers = {name: quantize(layer_buffers[name][0] if len(channels) == 1 else layer_buffers[name], dtype) for name, channels, dtype in LAYER_SPECS}
+
+    # Alpha is returned either as a constant value or as a compressed chunk of its own.
+    # Only compressed bytes leave this function, the buffers are overwritten by the next frame
+    layers['combined'], alpha = split_alpha(layers['combined'])
+    if not isinstance(alpha, float):
+        alpha = compress_chunk(alpha)
+
+    return (width, height), {name: (data.shape, data.dtype, compress_chunk(data)) for name, data in layers.items()}, alpha
+
+def init_worker(exr_threads):
+    # Let OpenEXR decompress the scanline blocks of a frame on several threads, bindings older than 3.3 lack this
+    if hasattr(OpenEXR, 'set_global_thread_count'):
+        OpenEXR.set_global_thread_count(exr_threads)
+
+def decode_frames(executor, frame_files, max_pending):
+    # Yield decoded frames in order, keeping at most max_pending frames in flight to cap memory
+    pending = deque()
+    for frame_file in frame_files:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(decode_frame, frame_file))
+    while pending:
+        yield pending.popleft().result()
+
 if __name__ == "__main__":
     args = get_argument_parser().parse_args()
 
@@ -96,13 +203,19 @@ if __name__ == "__main__":
         raise ValueError(f"[!] Not enough frames to assemble sequences with {args.frames_per_sequence} frames")
     print(f"[>] Using {args.frames_per_sequence} frames per sequence, assembling {n_sequences} sequences for each resolution")
     print(f"[>] Using sequences {args.test_sequences} for testing")
+    test_sequences = frozenset(args.test_sequences)
 
     output_file.parent.mkdir(parents=True, exist_ok=True)
-    with h5py.File(args.output, 'a' if args.append else 'w') as f:
+    # Split the cores between worker processes and OpenEXR's decoding threads inside each of them
+    exr_threads = max(1, os.cpu_count() // args.workers)
+
+    # Chunks are stored with write_direct_chunk and never read back, so HDF5's default chunk cache is left as is
+    file_mode = 'a' if args.append else 'w'
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(exr_threads,)) as executor, \
+         h5py.File(args.output, file_mode) as f:
         f.attrs['total-frames'] = n_frames
         f.attrs['frames-per-sequence'] = args.frames_per_sequence
         f.attrs['sequence-index-digits'] = args.sequence_index_digits
-        f.attrs['frame-index-digits'] = args.frame_index_digits
         f.attrs['test-sequences'] = len(args.test_sequences)
         f.attrs['train-sequences'] = n_sequences - len(args.test_sequences)
         
@@ -118,7 +231,7 @@ if __name__ == "__main__":
             test_seq_index  = 0
             
             for sequence in range(n_sequences):
-                if sequence in args.test_sequences:
+                if sequence in test_sequences:
                     print(f"[>] Assembling sequence {sequence} | Test")
                     seq_group = test_group.create_group(f"seq-{test_seq_index:0{args.sequence_index_digits}d}")
                     test_seq_index += 1
@@ -127,33 +240,43 @@ if __name__ == "__main__":
                     seq_group = train_group.create_group(f"seq-{train_seq_index:0{args.sequence_index_digits}d}")
                     train_seq_index += 1
 
-                progress_bar = tqdm(range(args.frames_per_sequence))
-                for frame in progress_bar:
-                    frame_group = seq_group.create_group(f"frame-{frame:0{args.frame_index_digits}d}")
-                    frame_file = subdir / f"frame-{frame + args.frames_per_sequence * sequence + 1:04d}.exr"
+                # Build all file names and progress labels of the sequence up front, outside the frame loop
+                first_frame = args.frames_per_sequence * sequence + 1
+                frame_files = [subdir / f"frame-{index:04d}.exr" for index in range(first_frame, first_frame + args.frames_per_sequence)]
+                descriptions = [f"{subdir.name} | {frame_file.name}" for frame_file in frame_files]
+                decoded_frames = decode_frames(executor, frame_files, 2 * args.workers)
 
-                    progress_bar.set_description(f"{subdir.name} | {frame_file.name}")
+                progress_bar = tqdm(zip(frame_files, descriptions, decoded_frames), total=args.frames_per_sequence)
+                datasets = None
+                alphas = []
+                for frame, (frame_file, description, (dimensions, layers, alpha)) in enumerate(progress_bar):
+                    progress_bar.set_description(description)
 
-                    exr = OpenEXR.InputFile(str(frame_file))
                     if frame_dimensions is None:
-                        frame_dimensions = get_image_dims(exr.header())
-                    elif frame_dimensions != get_image_dims(exr.header()):
-                        progress_bar.write(f"[!] Detected inconsistent frame dimensions in {frame_file.name}")
+                        frame_dimensions = dimensions
+                    elif frame_dimensions != dimensions:
+                        raise ValueError(f"[!] Detected inconsistent frame dimensions in {frame_file.name}")
+
+                    # Each layer of the sequence lives in a single (frames, ...) dataset, chunks are written as they arrive
+                    if datasets is None:
+                        datasets = {name: add_dataset(seq_group, name, (args.frames_per_sequence, *shape), dtype) for name, (shape, dtype, _) in layers.items()}
+
+                    for name, (shape, _, chunk) in layers.items():
+                        datasets[name].id.write_direct_chunk((frame, *(0,) * len(shape)), chunk)
 
+                    # Only alpha is held back so that the constant-alpha decision is made once per sequence
+                    alphas.append(alpha)
+
+                # A constant alpha is kept as the 'alpha-const' attribute of 'combined', otherwise it gets its own dataset
+                if len(set(alphas)) == 1 and isinstance(alphas[0], float):
+                    datasets['combined'].attrs['alpha-const'] = alphas[0]
+                else:
                     width, height = frame_dimensions
-                    frame_group.create_dataset('combined', data=load_exr_layer(exr, 'Combined', width, height, with_alpha=True), dtype=np.float32)
-                    frame_group.create_dataset('normal', data=load_exr_layer(exr, 'Normal', width, height, use_xyzw=True), dtype=np.float32)
-                    frame_group.create_dataset('vector', data=load_exr_layer(exr, 'Vector', width, height, use_xyzw=True, with_alpha=True), dtype=np.float32)
-                    frame_group.create_dataset('depth', data=load_exr_layer_single(exr, 'Mist.Z', width, height), dtype=np.float32)
-                    frame_group.create_dataset('diffuse-col', data=load_exr_layer(exr, 'DiffCol', width, height), dtype=np.float32)
-                    frame_group.create_dataset('diffuse-dir', data=load_exr_layer(exr, 'DiffDir', width, height), dtype=np.float32)
-                    frame_group.create_dataset('diffuse-ind', data=load_exr_layer(exr, 'DiffInd', width, height), dtype=np.float32)
-                    frame_group.create_dataset('glossy-col', data=load_exr_layer(exr, 'GlossCol', width, height), dtype=np.float32)
-                    frame_group.create_dataset('glossy-dir', data=load_exr_layer(exr, 'GlossDir', width, height), dtype=np.float32)
-                    frame_group.create_dataset('glossy-ind', data=load_exr_layer(exr, 'GlossInd', width, height), dtype=np.float32)
-                    frame_group.create_dataset('emission', data=load_exr_layer(exr, 'Emit', width, height), dtype=np.float32)
-                    frame_group.create_dataset('environment', data=load_exr_layer(exr, 'Env', width, height), dtype=np.float32)
-                    frame_group.create_dataset('roughness', data=load_exr_layer_single(exr, 'Roughness.X', width, height), dtype=np.float32)
+                    alpha_chunks = [compress_chunk(np.full((height, width), alpha, dtype=np.float32)) if isinstance(alpha, float) else alpha for alpha in alphas]
+                    write_chunks(add_dataset(seq_group, 'alpha', (args.frames_per_sequence, height, width), np.float32), alpha_chunks)
+
+                # Flush at sequence boundaries so dirty metadata is written out instead of piling up in the cache
+                f.flush()
         
             resolution_group.attrs['frame-width']  = frame_dimensions[0]
             resolution_group.attrs['frame-height'] = frame_dimensions[1]
@@ -65,6 +65,11 @@ if __name__ == "__main__":
         nodes = material.node_tree.nodes
         links = material.node_tree.links
 
+        # Find the Principled BSDF node first, materials without one are left untouched
+        bsdf_node = next((node for node in nodes if node.type == 'BSDF_PRINCIPLED'), None)
+        if bsdf_node is None:
+            continue
+
         # Add an AOV Output node if it doesn't already exist
         aov_node = nodes.get("AOV Output")
         if not aov_node:
@@ -74,16 +79,6 @@ if __name__ == "__main__":
         # Set the AOV name in the node to match our AOV
         aov_node.aov_name = rough_pass_name
 
-        # Find the Principled BSDF node or another shader node with a roughness input
-        bsdf_node = None
-        for node in nodes:
-            if node.type == 'BSDF_PRINCIPLED':  # Look for Principled BSDF node
-                bsdf_node = node
-                break
-    
-        if not bsdf_node:
-            continue
-
         # Check if the input to roughness of BSDF is connected to something
         roughness_socket = bsdf_node.inputs['Roughness']
         if roughness_socket.is_linked: